@@ -9,29 +9,58 @@ Text after # on any line is treated as an inline comment and stripped.
 
 import serial
 import time
+import os
+import select
 import sys
 import argparse
 import logging
 import re
+import functools
+from collections import deque
 from datetime import datetime
 
 
+@functools.lru_cache(maxsize=256)
+def encode_command(command):
+    """Encode a command line for the serial port (cached, scripts repeat commands)."""
+    return f"{command}\n".encode()
+
+
 class I2CCommandRunner:
-    def __init__(self, port, baudrate, command_file):
+    def __init__(self, port, baudrate, command_file, terminator="OK", legacy_drain=False):
         self.port = port
         self.baudrate = baudrate
         self.command_file = command_file
+        self.terminator = terminator.encode()
+        self.legacy_drain = legacy_drain
         self.ser = None
         self.last_response = ""
         self.line_number = 0
         self.executed_count = 0
         self.variables = {}
+        self.variable_pattern = None
+        self.out = sys.stdout
+        self.pending_commands = deque()
+        self.pending_bytes = 0
+        # Unanswered bytes must fit the 64 byte AVR receive ring buffer
+        # (63 usable), as flow control is disabled
+        self.pending_limit = 63
+        # Without a terminator a response is complete once the line stream has
+        # been quiet this long (covers the I2C transfer between two lines)
+        self.idle_timeout = 0.02
+        self.expect_patterns = {}
 
     def connect(self):
         """Connect to Arduino via serial port."""
-        self.ser = serial.Serial(self.port, self.baudrate, timeout=2)
+        self.ser = serial.Serial(self.port, self.baudrate, timeout=2,
+                                 rtscts=False, xonxoff=False, dsrdtr=False)
+        try:
+            # Avoid the 16 ms latency timer of FTDI-style USB adapters
+            self.ser.set_low_latency_mode(True)
+        except (NotImplementedError, OSError, ValueError, AttributeError) as e:
+            logging.debug("Low latency mode unavailable: %s", e)
         time.sleep(0.25)  # Wait for Arduino to reset
-        logging.info(f"Connected to I2C bridge on {self.port}")
+        logging.info("Connected to I2C bridge on %s", self.port)
 
     def disconnect(self):
         """Close serial connection."""
@@ -46,12 +75,9 @@ class I2CCommandRunner:
         if not line:
             return None, None
         
-        if '#' in line:
-            command = line.split('#')[0].strip()
-            comment = line.split('#', 1)[1].strip()
-        else:
-            command = line
-            comment = ""
+        head, sep, tail = line.partition('#')
+        command = head.strip()
+        comment = tail.strip() if sep else ""
         
         return command, comment
 
@@ -69,14 +95,27 @@ class I2CCommandRunner:
             var_value = var_value[1:-1]
         
         self.variables[var_name] = var_value
-        logging.debug(f"Variable set: {var_name} = {var_value}")
+        self.variable_pattern = None  # Rebuilt on next substitution
+        logging.debug("Variable set: %s = %s", var_name, var_value)
         return True
 
     def substitute_variables(self, command):
         """Replace variable names with their values in command."""
-        for var_name, var_value in self.variables.items():
-            command = command.replace(var_name, var_value)
-        return command
+        if not self.variables:
+            return command
+
+        if self.variable_pattern is None:
+            # Longest names first so that e.g. XY wins over X
+            names = sorted(self.variables, key=len, reverse=True)
+            self.variable_pattern = re.compile(r'\b(' + '|'.join(map(re.escape, names)) + r')\b')
+
+        # The capturing group puts variable names at the odd indices, so the
+        # values can be looked up without a Python callback per match
+        parts = self.variable_pattern.split(command)
+        if len(parts) == 1:
+            return command
+        parts[1::2] = map(self.variables.__getitem__, parts[1::2])
+        return "".join(parts)
 
     def handle_expect_command(self, command):
         """Handle EXPECT command for response validation."""
@@ -86,99 +125,200 @@ class I2CCommandRunner:
         # Substitute variables in expected pattern
         expected = self.substitute_variables(expected)
 
-        try:
-            if re.match(expected, self.last_response):
-                print(f"---> EXPECT \"{expected}\" ✓")
-            else:
-                logging.error(f"EXPECT failed on line {self.line_number}")
-                logging.error(f"Expected pattern: \"{expected}\"")
-                logging.error(f"Received: \"{self.last_response}\"")
+        # Compile each distinct pattern only once
+        pattern = self.expect_patterns.get(expected)
+        if pattern is None:
+            try:
+                pattern = re.compile(expected)
+            except re.error as e:
+                self.out.flush()
+                logging.error("EXPECT failed on line %d: Invalid regex pattern", self.line_number)
+                logging.error("Pattern: \"%s\"", expected)
+                logging.error("Regex error: %s", e)
                 sys.exit(1)
-        except re.error as e:
-            logging.error(f"EXPECT failed on line {self.line_number}: Invalid regex pattern")
-            logging.error(f"Pattern: \"{expected}\"")
-            logging.error(f"Regex error: {e}")
+            self.expect_patterns[expected] = pattern
+
+        if pattern.match(self.last_response):
+            self.out.write(f"---> EXPECT \"{expected}\" ✓\n")
+        else:
+            self.out.flush()
+            logging.error("EXPECT failed on line %d", self.line_number)
+            logging.error("Expected pattern: \"%s\"", expected)
+            logging.error("Received: \"%s\"", self.last_response)
             sys.exit(1)
 
     def send_command(self, command):
-        """Send command to Arduino and read response."""
+        """Send command to Arduino, reading responses first if the window is full."""
         # Substitute variables in command
         original_command = command
         command = self.substitute_variables(command)
-        
+
         if original_command != command:
-            logging.debug(f"After variable substitution: {original_command} -> {command}")
+            logging.debug("After variable substitution: %s -> %s", original_command, command)
         
-        logging.debug(f"Sending command: {command}")
-        print(f"---> {command}")
-        self.ser.write(f"{command}\n".encode())
+        logging.debug("Sending command: %s", command)
+        data = encode_command(command)
+        if self.pending_bytes + len(data) > self.pending_limit:
+            self.flush_pending()
+
+        # Hand the command to the port right away so the Arduino works on it
+        # while the next lines are prepared; responses are read in batches.
+        # This costs one write per command instead of one per batch, which is
+        # negligible next to the time the bytes spend on the wire.
+        self.ser.write(data)
+        self.pending_commands.append((self.line_number, command))
+        self.pending_bytes += len(data)
         self.executed_count += 1
-        
-        # Read response from Arduino
+
+        if self.legacy_drain:
+            # Without a terminator, lines can only be matched to the command
+            # that produced them by reading its response before the next one
+            self.flush_pending()
+
+    def flush_pending(self):
+        """Read the responses of all commands sent since the last flush."""
+        if not self.pending_commands:
+            return
+
+        logging.debug("Reading responses of %d commands (%d bytes)",
+                      len(self.pending_commands), self.pending_bytes)
+        self.pending_bytes = 0
+        # Show progress before blocking on the responses
+        self.out.flush()
+
+        while self.pending_commands:
+            # Echo each command right above its own response
+            line_number, command = self.pending_commands.popleft()
+            self.out.write("---> ")
+            self.out.write(command)
+            self.out.write("\n")
+
+            if not self.legacy_drain:
+                # The firmware ends each command's response with a terminator line
+                self.read_until_terminator(line_number)
+            else:
+                self.read_until_idle()
+
+        self.out.flush()
+
+    def read_until_idle(self):
+        """Handle response lines until the Arduino stops sending."""
         self.last_response = ""
-        time.sleep(0.1)
-        while self.ser.in_waiting > 0:
-            response = self.ser.readline().decode().strip()
-            if response:
-                if response.startswith("[DBG]"):
-                    logging.debug(response)
-                else:
-                    print(f"<--- {response}")
-                    self.last_response = response
+        # Every command answers with at least one line, so block for that one
+        self.handle_response(self.ser.read_until(b'\n'))
+        while self.response_waiting(self.idle_timeout):
+            raw = self.ser.readline()
+            if not raw:
+                break
+            self.handle_response(raw)
+
+    def read_until_terminator(self, line_number):
+        """Handle response lines until the command's terminator line arrives."""
+        # EXPECT always checks the response of the command right before it
+        self.last_response = ""
+        while True:
+            raw = self.ser.readline()
+            if not raw:
+                # Responses can no longer be matched to their commands
+                self.out.flush()
+                logging.error("No \"%s\" received before timeout on line %d",
+                              self.terminator.decode(), line_number)
+                logging.error("Use --legacy-drain for firmware that does not send it")
+                sys.exit(1)
+            if raw.strip() == self.terminator:
+                return
+            self.handle_response(raw)
+
+    def response_waiting(self, timeout):
+        """Wait up to timeout seconds for more response data to arrive."""
+        if os.name == 'nt':
+            # No pollable file descriptor on Windows, poll the driver instead
+            deadline = time.monotonic() + timeout
+            while self.ser.in_waiting == 0:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.001)
+            return True
+        return bool(select.select([self.ser.fileno()], [], [], timeout)[0])
+
+    def handle_response(self, raw):
+        """Print a response line or log it if it is a debug line."""
+        response = raw.strip()
+        if not response:
+            return
+
+        if response.startswith(b"[DBG]"):
+            # Debug lines are only decoded when they will actually be shown
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(response.decode(errors="replace"))
+        else:
+            response = response.decode(errors="replace")
+            self.out.write("<--- ")
+            self.out.write(response)
+            self.out.write("\n")
+            self.last_response = response
 
     def execute_commands(self):
         """Execute all commands from the command file."""
         try:
             self.connect()
-            logging.info(f"Starting execution of commands from: {self.command_file}")
+            logging.info("Starting execution of commands from: %s", self.command_file)
             
             with open(self.command_file, 'r') as f:
-                for line in f:
-                    self.line_number += 1
-                    
-                    command, comment = self.parse_line(line)
-                    
-                    if command is None:
-                        continue
-                    
-                    if comment:
-                        logging.debug(f"Line {self.line_number}: '{command}' # {comment}")
-                    else:
-                        logging.debug(f"Line {self.line_number}: '{command}'")
-                    
-                    if not command:
-                        continue
-                    
-                    # Handle variable assignment
-                    if self.handle_variable_assignment(command):
-                        continue
-                    
-                    # Handle EXPECT command
-                    if command.upper().startswith("EXPECT "):
-                        self.handle_expect_command(command)
-                        continue
-                    
-                    # Send regular command
-                    self.send_command(command)
-
-            logging.debug(f"Execution completed: {self.executed_count} commands from {self.line_number} lines")
+                text = f.read()
+
+            # Skip the EXPECT check entirely for scripts without any
+            has_expect = 'EXPECT' in text.upper()
+            lines = text.splitlines()
+
+            for line in lines:
+                self.line_number += 1
+                
+                command, comment = self.parse_line(line)
+                
+                if command is None:
+                    continue
+                
+                if comment:
+                    logging.debug("Line %d: '%s' # %s", self.line_number, command, comment)
+                else:
+                    logging.debug("Line %d: '%s'", self.line_number, command)
+                
+                if not command:
+                    continue
+                
+                # Handle variable assignment
+                if self.handle_variable_assignment(command):
+                    continue
+                
+                # Handle EXPECT command
+                if has_expect and command[:7].upper() == "EXPECT ":
+                    self.flush_pending()
+                    self.handle_expect_command(command)
+                    continue
+                
+                # Send regular command
+                self.send_command(command)
+
+            self.flush_pending()
+            logging.debug("Execution completed: %d commands from %d lines", self.executed_count, self.line_number)
             
         except FileNotFoundError:
-            logging.error(f"Command file '{self.command_file}' not found")
+            logging.error("Command file '%s' not found", self.command_file)
             sys.exit(1)
         except serial.SerialException as e:
-            logging.error(f"Serial connection error on {self.port}: {e}")
+            logging.error("Serial connection error on %s: %s", self.port, e)
             sys.exit(1)
         except Exception as e:
-            logging.error(f"Unexpected error: {e}")
+            logging.error("Unexpected error: %s", e)
             sys.exit(1)
         finally:
             self.disconnect()
 
 
-def run_command_file(port, baudrate, command_file):
+def run_command_file(port, baudrate, command_file, terminator="OK", legacy_drain=False):
     """Execute commands from file on Arduino I2C bridge."""
-    runner = I2CCommandRunner(port, baudrate, command_file)
+    runner = I2CCommandRunner(port, baudrate, command_file, terminator, legacy_drain)
     runner.execute_commands()
 
 
@@ -187,10 +327,14 @@ def main():
     parser.add_argument('command_file', help='Path to command file')
     parser.add_argument('-p', '--port', default='/dev/ttyACM0', 
                        help='Serial port (default: /dev/ttyACM0)')
-    parser.add_argument('-b', '--baudrate', type=int, default=9600,
-                       help='Baudrate (default: 9600)')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200,
+                       help='Baudrate (default: 115200)')
     parser.add_argument('-v', '--verbose', action='store_true',
                        help='Enable verbose logging (Arduino responses)')
+    parser.add_argument('-t', '--terminator', default='OK',
+                       help='Line sent by the firmware after each command (default: OK)')
+    parser.add_argument('--legacy-drain', action='store_true',
+                       help='Read responses without waiting for a terminator (older firmware)')
     
     args = parser.parse_args()
     
@@ -204,7 +348,8 @@ def main():
         logging.getLogger().setLevel(logging.DEBUG)
     
 
-    run_command_file(args.port, args.baudrate, args.command_file)
+    run_command_file(args.port, args.baudrate, args.command_file,
+                     args.terminator, args.legacy_drain)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ uint8_t address;
 bool showDebug = true;
 
 void setup() {
-    Serial.begin(9600);
+    Serial.begin(115200);
     Serial.setTimeout(100000);
     Wire.begin();
 
@@ -237,4 +237,6 @@ void loop() {
     String line = Serial.readStringUntil('\n');
     line.trim();
     processLine(line);
+    // Tell the host that all output for this command has been sent
+    Serial.println("OK");
 }